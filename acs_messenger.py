@@ -1,23 +1,23 @@
 import os
 import re
-import psutil
 import sys
 import json
 import time
+import math
 import signal
+import threading
+import concurrent.futures
 import random
 import logging
 import platform
+import zlib
 import base64
 import getopt
-import pprint
 import datetime
+import unicodedata
 import psycopg2
-import sendgrid
 
-from psycopg2.extras import DictCursor
-from twilio.rest import Client
-from sendgrid.helpers.mail import *
+from psycopg2.extras import DictCursor, execute_values
 from logging.handlers import TimedRotatingFileHandler
 
 # Constants
@@ -26,26 +26,147 @@ HOSTNAME = platform.node().split('.')[0]
 FETCH_LIMIT = 5
 MAX_ATTEMPTS = 3
 MAX_AGE = 15 # minutes
+SMS_SENDER_RATE = 1.0 # Messages per second per sender number (long code limit)
+SMS_MAX_SEGMENTS = 4 # Longer messages are truncated to fit
+METRICS_INTERVAL = 60 # seconds between metric log lines
+ARCHIVE_FLUSH_SIZE = 50 # Buffered archive rows before a flush
+ARCHIVE_FLUSH_SECONDS = 2 # Max age of the oldest buffered archive row
+PARTITIONED_TABLES = ("MailArchive", "FailedMail") # Monthly partitions on "DateSent"
+PARTITION_PRECREATE_MONTHS = 3
+ARCHIVE_RETENTION_MONTHS = 13
+DRAIN_SECONDS = 20 # How long in-flight sends get to finish after a shutdown signal
+SUPPRESSION_TTL = 300 # seconds before the suppression list is reloaded
+SENDGRID_SUPPRESSION_LISTS = ("bounces", "blocks", "invalid_emails", "spam_reports", "unsubscribes")
+TWILIO_SUPPRESSION_CODES = {21610: "recipient opted out", 21614: "not a mobile number"}
+CONFIG_POLL_SECONDS = 30
+NEXT_DUE_REFRESH = 30 # seconds an idle worker trusts its cached next send_at
+PROFILE_BATCHES = 50 # Batches profiled per SIGUSR1
+JOURNAL_COMPACT_LINES = 1000 # Send journal lines before it is rewritten with only the open entries
+SMS_PROVIDERS = "twilio" # Failover order when neither $SMS_PROVIDERS nor --sms-providers is set
+EMAIL_PROVIDERS = "sendgrid"
+PROVIDER_FAILURE_LIMIT = 3 # Consecutive failures before a provider is moved to the back of the order
+PROVIDER_COOLDOWN = 60 # seconds a failing provider stays at the back
+SMTP_TIMEOUT = 30
+EMAIL_SENDER = 'bamsupport@airgas-rd.com' # override until mail.airgas-rd.com is validated with twilio
+
+# Values that --tuning-file (re-read on SIGHUP) and the MessengerConfig table can change at runtime
+TUNABLES = {
+    "interval": ("interval", float),
+    "fetch_limit": ("FETCH_LIMIT", int),
+    "max_attempts": ("MAX_ATTEMPTS", int),
+    "sender_rate": ("sender_rate", float),
+    "max_segments": ("max_segments", int),
+    "email_override": ("email_override", str),
+    "phone_override": ("phone_override", str),
+}
+
+# GSM 03.38 alphabet. Anything outside of it forces UCS-2 (70 chars per segment instead of 160)
+GSM7_BASIC_CHARS = frozenset(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_EXTENDED_CHARS = frozenset("^{}\\[~]|€\f") # Cost two septets (escape + char)
+GSM7_TRANSLITERATIONS = {
+    "‘": "'", "’": "'", "‚": "'", "‛": "'", "′": "'", "‹": "'", "›": "'", "`": "'",
+    "“": '"', "”": '"', "„": '"', "‟": '"', "″": '"', "«": '"', "»": '"',
+    "‐": "-", "‑": "-", "‒": "-", "–": "-", "—": "-", "―": "-", "−": "-",
+    "…": "...", "•": "*", "·": "*", "\t": " ", "\u00a0": " ", "\u2002": " ", "\u2003": " ",
+    "\u2009": " ", "\u202f": " ", "\u200b": "", "\ufeff": "", "©": "(c)", "®": "(R)", "™": "TM",
+}
+
+MODE_CONSTRAINTS = {
+    None: "TRUE", # Gets all records
+    'report': '"Attachment" IS NOT NULL',
+    'notification': '"Attachment" IS NULL',
+}
+
+# Applied by --install-schema. Every statement is idempotent
+SCHEMA_SQL = [
+    'ALTER TABLE mail."MailQueue" ADD COLUMN IF NOT EXISTS claimed_at timestamptz',
+    'ALTER TABLE mail."MailQueue" ADD COLUMN IF NOT EXISTS send_at timestamptz', # NULL sends right away
+    'CREATE INDEX IF NOT EXISTS "MailQueue_send_at_idx" ON mail."MailQueue" (send_at, "ID") WHERE "deliveryMethod" IS NULL AND send_at IS NOT NULL',
+    *[
+        f'CREATE INDEX IF NOT EXISTS "MailQueue_claim_{m or "all"}_idx" ON mail."MailQueue" ("ID") WHERE "deliveryMethod" IS NULL AND {constraint}'
+        for m, constraint in MODE_CONSTRAINTS.items()
+    ], # One per --mode so the claim scan walks "ID" order over only that mode's rows
+    *[
+        f'''ALTER TABLE mail."{table}"
+            ADD COLUMN IF NOT EXISTS created_at timestamptz,
+            ADD COLUMN IF NOT EXISTS claimed_at timestamptz,
+            ADD COLUMN IF NOT EXISTS provider_sent_at timestamptz,
+            ADD COLUMN IF NOT EXISTS provider_message_id text'''
+        for table in ("MailArchive", "FailedMail")
+    ],
+    'CREATE INDEX IF NOT EXISTS "MailArchive_DateSent_idx" ON mail."MailArchive" ("DateSent")', # Lag report range scans
+    'CREATE INDEX IF NOT EXISTS "FailedMail_DateSent_idx" ON mail."FailedMail" ("DateSent")',
+    '''CREATE TABLE IF NOT EXISTS mail."MessengerSourceWeight" (
+        "SourceAddress" text PRIMARY KEY,
+        weight real NOT NULL DEFAULT 1 CHECK (weight > 0)
+    )''', # --fair share per source. Sources without a row get weight 1
+    'CREATE INDEX IF NOT EXISTS "MailQueue_fair_idx" ON mail."MailQueue" ("SourceAddress", "ID") WHERE "deliveryMethod" IS NULL',
+    '''CREATE TABLE IF NOT EXISTS mail."SuppressedAddress" (
+        address text PRIMARY KEY,
+        reason text,
+        source text,
+        created_at timestamptz NOT NULL DEFAULT NOW()
+    )''', # Hard bounces and opt outs. Sends to these are archived without a provider call
+    '''CREATE TABLE IF NOT EXISTS mail."MessengerConfig" (
+        name text NOT NULL,
+        value text,
+        target text NOT NULL DEFAULT '*', -- '*', a mode ('report', 'notification', 'all') or a worker identifier
+        PRIMARY KEY (name, target)
+    )''', # Polled by workers started with --config-table
+]
 
 # Env vars set in netadmin .bash_profile
 my_twilio_phone_number = os.environ.get("TWILIO_PHONE_NUMBER")
+my_twilio_phone_numbers = os.environ.get("TWILIO_PHONE_NUMBERS") # Comma separated sender pool
+my_twilio_messaging_service_sid = os.environ.get("TWILIO_MESSAGING_SERVICE_SID")
+my_twilio_messaging_service_size = os.environ.get("TWILIO_MESSAGING_SERVICE_SIZE") # Numbers in the messaging service
 sendgrid_client_api_key = os.environ.get("SENDGRID_CLIENT_API_KEY")
 twilio_account_sid = os.environ.get("TWILIO_ACCOUNT_SID")
 twilio_api_key_sid = os.environ.get("TWILIO_CLIENT_API_KEY_SID")
 twilio_api_key_secret= os.environ.get("TWILIO_CLIENT_API_KEY_SECRET")
 pgpassword = os.environ.get("PGPASSWORD")
+smtp_host = os.environ.get("SMTP_HOST", "localhost")
+smtp_port = int(os.environ.get("SMTP_PORT", "25"))
+smtp_user = os.environ.get("SMTP_USER") # STARTTLS and login when set
+smtp_password = os.environ.get("SMTP_PASSWORD")
+sms_gateway_domain = os.environ.get("SMS_GATEWAY_DOMAIN") # Email-to-SMS gateway for numbers without a carrier domain
 user_home = os.environ.get("HOME")
 
-# DB config
-with open(f"{user_home}/scripts/db_params.json") as f:
-    db_params = json.load(f)
-    db_params["password"] = pgpassword
-
 # Globals
 conn = None
+db_params = None
 sg = None
 sms_client = None
+sms_senders = []
+sender_next_slot = {}
+sender_lock = threading.Lock() # Sender slots and metrics are shared by the send threads
+client_lock = threading.Lock()
+metrics = {"sms_sent": 0, "sms_segments": 0, "sms_ucs2": 0, "sms_truncated": 0, "claims_stolen": 0, "suppressed": 0, "failovers": 0, "provider_failures": 0}
+last_metrics_log = time.monotonic()
+archive_buffer = [] # (record, success, sent_at) waiting for a bulk archive
+archive_buffer_started = None
+suppressed_addresses = set()
+suppressions_loaded_at = None
+executor = None
 should_terminate = False
+reload_requested = False
+last_config_poll = 0.0
+next_due_at = 0.0 # Monotonic time the next scheduled message is due. 0 forces a lookup
+next_due_checked = 0.0
+profiler = None
+profile_batches_left = 0
+profile_toggle_requested = False
+drain_deadline = None
+unsent_ids = [] # Claimed but never handed to a provider
+stranded_ids = [] # Still sending when the drain deadline passed
+journal_file = None # Sends recorded before their archive commits. {log_dir}/{my_process_identifier}.journal
+journal_entries = {} # "ID" -> journal entry still waiting for its archive commit
+journal_lines = 0
+journal_lock = threading.Lock()
+provider_health = {} # (channel, name) -> (consecutive failures, monotonic time its cool-down ends)
 
 # CLI defaults
 debug_mode = False
@@ -58,53 +179,190 @@ interval = 1.0
 log_dir = None
 email_override = None
 phone_override = None
+sender_rate = SMS_SENDER_RATE
+max_segments = SMS_MAX_SEGMENTS
+write_behind = False
+command = None # One-off admin command run instead of the worker loop
+retention_months = ARCHIVE_RETENTION_MONTHS
+drop_expired = False
+report_since = None
+report_until = None
+fair_queuing = False
+suppression_file = None
+tuning_file = None
+config_table = False
+profile_batches = 0
+shard_count = 1
+shard_index = 0
+drain_seconds = DRAIN_SECONDS
+workers = 1
+sms_providers = [p.strip() for p in os.environ.get("SMS_PROVIDERS", SMS_PROVIDERS).split(',')]
+email_providers = [p.strip() for p in os.environ.get("EMAIL_PROVIDERS", EMAIL_PROVIDERS).split(',')]
 my_process_identifier = None
 
 def shutdown(signum, frame):
-    global should_terminate
-    logging.info(f"Received signal {signum}. Shutting down...")
-    should_terminate = True
+    global should_terminate, drain_deadline
+    logging.info(f"Received signal {signum}. Draining for up to {drain_seconds}s...")
+    should_terminate = True # Stop claiming
+    drain_deadline = time.monotonic() + drain_seconds
+
+def toggle_profile(signum, frame):
+    global profile_toggle_requested
+    logging.info(f"Received signal {signum}. Toggling profiler at the next batch")
+    profile_toggle_requested = True
+
+def start_profile(batches):
+    global profiler, profile_batches_left
+    import cProfile
+    profiler = cProfile.Profile()
+    profile_batches_left = batches
+    logging.info(f"Profiling the next {batches} batches")
+
+def stop_profile():
+    global profiler
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y_%m_%d_%H_%M_%S")
+    path = os.path.join(log_dir, f"{my_process_identifier}_{stamp}.pstats")
+    try:
+        profiler.dump_stats(path) # Load with pstats, snakeviz or flameprof
+        logging.info(f"Profile written to {path}")
+    except OSError as e:
+        logging.error(f"Could not write profile {path}: {e}")
+    profiler = None
+
+def profile_batch_start():
+    global profile_toggle_requested
+    if profile_toggle_requested:
+        profile_toggle_requested = False
+        if profiler:
+            stop_profile()
+        else:
+            start_profile(PROFILE_BATCHES)
+    if profiler:
+        profiler.enable()
+
+def profile_batch_end():
+    global profile_batches_left
+    if not profiler:
+        return
+    profiler.disable()
+    profile_batches_left -= 1
+    if profile_batches_left <= 0:
+        stop_profile()
+
+def request_reload(signum, frame):
+    global reload_requested
+    logging.info(f"Received signal {signum}. Reloading tuning before the next batch")
+    reload_requested = True
 
 signal.signal(signal.SIGINT, shutdown)
 signal.signal(signal.SIGTERM, shutdown)
+signal.signal(signal.SIGHUP, request_reload)
+signal.signal(signal.SIGUSR1, toggle_profile)
 
-def process_records():
-    constraint = "TRUE"  # Gets all records
-    if mode == 'report':
-        constraint = '"Attachment" IS NOT NULL'
-    elif mode == 'notification':
-        constraint = '"Attachment" IS NULL'
+def build_claim_sql(shard_filter="TRUE"):
+    constraint = MODE_CONSTRAINTS[mode]
 
-    select_sql = f"""
-    SELECT "ID", processed_by
-    FROM mail."MailQueue"
-    WHERE pg_try_advisory_xact_lock("ID")
-      AND "deliveryMethod" IS NULL
+    predicates = f"""
+      "deliveryMethod" IS NULL
       AND (
           processed_by IS NULL -- New message
           OR processed_by = %s -- Previous failure
-          OR (processed_by <> %s AND created_at < NOW() - '{MAX_AGE} minutes'::interval) -- Orphaned message
+          OR (processed_by <> %s AND COALESCE(claimed_at, created_at) < NOW() - '{MAX_AGE} minutes'::interval) -- Orphaned message
       )
+      AND (send_at IS NULL OR send_at <= NOW()) -- Scheduled messages wait until they are due
       AND {constraint}
-      AND attempts <= {MAX_ATTEMPTS}
+      AND NOT ("ID" = ANY(%s::bigint[])) -- Sent and waiting in the archive buffer
+      AND {shard_filter}"""
+
+    batch = max(FETCH_LIMIT, workers)
+
+    if fair_queuing:
+        # Skip scan MailQueue_fair_idx for the distinct sources, then take at most one batch from each in "ID" order.
+        # Work grows with the number of sources, not with the size of a flood. Round robin by weight over what was taken,
+        # and only the rows that make the cut are locked
+        return f"""
+    WITH RECURSIVE sources AS (
+        SELECT min("SourceAddress") AS source FROM mail."MailQueue" WHERE "deliveryMethod" IS NULL
+        UNION ALL
+        SELECT (SELECT min("SourceAddress") FROM mail."MailQueue" WHERE "deliveryMethod" IS NULL AND "SourceAddress" > s.source)
+        FROM sources s
+        WHERE s.source IS NOT NULL
+    ), picked AS (
+        SELECT q."ID", q.processed_by, s.source
+        FROM sources s
+        CROSS JOIN LATERAL (
+            SELECT c."ID", c.processed_by
+            FROM mail."MailQueue" c
+            WHERE c."SourceAddress" = s.source AND {predicates}
+            ORDER BY c."ID"
+            LIMIT {batch}
+        ) q
+        UNION ALL
+        SELECT * FROM (
+            SELECT c."ID", c.processed_by, NULL AS source
+            FROM mail."MailQueue" c
+            WHERE c."SourceAddress" IS NULL AND {predicates}
+            ORDER BY c."ID"
+            LIMIT {batch}
+        ) unsourced -- The skip scan never lands on NULL
+    ), chosen AS (
+        SELECT p."ID" AS pick, (ROW_NUMBER() OVER (PARTITION BY p.source ORDER BY p."ID") - 1) / COALESCE(w.weight, 1) AS round
+        FROM picked p
+        LEFT JOIN mail."MessengerSourceWeight" w ON w."SourceAddress" = p.source
+        ORDER BY round, p."ID"
+        LIMIT {batch}
+    )
+    SELECT c."ID", c.processed_by
+    FROM chosen ch
+    JOIN mail."MailQueue" c ON c."ID" = ch.pick
+    WHERE {predicates} -- Rechecked on the locked row in case another process claimed it meanwhile
+    ORDER BY ch.round, c."ID"
+    FOR UPDATE OF c SKIP LOCKED
+    """
+
+    return f"""
+    SELECT "ID", processed_by
+    FROM mail."MailQueue"
+    WHERE {predicates}
     ORDER BY "ID" ASC
-    LIMIT {FETCH_LIMIT}
+    LIMIT {batch}
     FOR UPDATE SKIP LOCKED
     """
 
+def claim_params(buffered):
+    params = (my_process_identifier, my_process_identifier, buffered)
+    return params * 3 if fair_queuing else params # The fair claim spells the predicates out three times
+
+def process_records():
+    shard_filters = ["TRUE"]
+    if shard_count > 1: # Own shard first, then steal from the others when it is empty
+        shard_filters = [f'"ID" %% {shard_count} = {shard_index}', f'"ID" %% {shard_count} <> {shard_index}'] # %% since the claim query takes bind parameters
+
     success_count, failed_count, skipped_count = 0, 0, 0
     try:
         cursor = conn.cursor()
+        refresh_suppressions(cursor)
         record = None
-        params = (my_process_identifier,) * 2
-        if debug_mode:
-            logging.debug(cursor.mogrify(select_sql, params).decode())
+        pending = []
+        params = claim_params(buffered_ids())
+        rows = []
+        for shard_filter in shard_filters:
+            select_sql = build_claim_sql(shard_filter)
+            if debug_mode:
+                logging.debug(cursor.mogrify(select_sql, params).decode())
 
-        cursor.execute(select_sql, params)
-        rows = cursor.fetchall()
+            cursor.execute(select_sql, params)
+            rows = cursor.fetchall()
+            if rows:
+                if shard_filter != shard_filters[0]:
+                    metrics["claims_stolen"] += len(rows)
+                break
 
         lock_query = "SELECT pg_try_advisory_xact_lock(%s);"
         for row in rows:
+            if should_terminate: # Draining. Leave the rest of the batch unclaimed
+                break
+
             if debug_mode:
                 logging.debug(cursor.mogrify(lock_query, (row["ID"],)).decode())
 
@@ -126,10 +384,10 @@ def process_records():
 
             update_sql = f"""
             UPDATE mail."MailQueue"
-            SET processed_by = %s, attempts = attempts + 1
+            SET processed_by = %s, attempts = attempts + 1, claimed_at = NOW()
             WHERE "ID" = %s
             AND {update_filter} -- Ensures the row is still in the same state from the select
-            RETURNING "ID", "DestinationAddress", "SourceAddress", "CC_Address", "BCC_Address", "Subject", "Body", "Attachment", attempts, processed_by
+            RETURNING "ID", "DestinationAddress", "SourceAddress", "CC_Address", "BCC_Address", "Subject", "Body", "Attachment", attempts, processed_by, created_at, claimed_at
             """
 
             if debug_mode:
@@ -142,32 +400,114 @@ def process_records():
                 skipped_count += 1
                 continue
 
+            record = dict(record) # Senders add the provider results to it
             message_type, valid = validate_message(record)
 
             if not valid:
-                archive_record(cursor,record,False) # Put it in FailedMail. No point in retrying
+                finalize_record(cursor,record,False) # Put it in FailedMail. No point in retrying
                 failed_count += 1
                 conn.commit()
                 continue
 
-            success = None
-            if message_type == 'sms':
-                success = send_sms(record)
-            elif message_type == 'email':
-                success = send_email(record)
+            if is_suppressed(record):
+                if debug_mode:
+                    logging.debug(f'{record["DestinationAddress"]} is suppressed. Not sending record id {record["ID"]}')
+                metrics["suppressed"] += 1
+                finalize_record(cursor,record,False) # Known bad recipient. Don't spend a send on it
+                failed_count += 1
+                if testing:
+                    conn.rollback()
+                else:
+                    conn.commit()
+                continue
+
+            if record["attempts"] > MAX_ATTEMPTS and record["ID"] not in journal_entries: # Out of attempts, e.g. max_attempts was lowered. Fail it without another send
+                finalize_record(cursor,record,False)
+                failed_count += 1
+                if testing:
+                    conn.rollback()
+                else:
+                    conn.commit()
+                continue
+
+            if executor is not None:
+                pending.append((record, message_type)) # Sent on the thread pool once the whole batch is claimed
+                continue
+
+            if not testing:
+                conn.commit() # Claim is durable before the send. A failed archive then leaves the row leased to us and journaled, not released to peers
+
+            success = send_message(record, message_type)
 
             if success:
                 success_count += 1
             else:
                 failed_count += 1
 
-            if success or record["attempts"] == MAX_ATTEMPTS:
-                archive_record(cursor,record,success) # Move record from MailQueue to (MailArchive on success | FailedMail on MAX_ATTEMPTS)
+            if record.get("suppress_reason"): # Provider says it will never be delivered
+                suppress_address(cursor,record["DestinationAddress"],record["suppress_reason"])
+
+            archived = False
+            if success or record["attempts"] >= MAX_ATTEMPTS or record.get("suppress_reason"):
+                archived = finalize_record(cursor,record,success) # Move record from MailQueue to (MailArchive on success | FailedMail on MAX_ATTEMPTS)
 
             if testing:
                 conn.rollback()
             else:
                 conn.commit()
+                if archived:
+                    journal_done([record["ID"]])
+
+        if pending and should_terminate: # Signal arrived while claiming. Release these instead of sending them
+            unsent_ids.extend(record["ID"] for record, _ in pending)
+            pending = []
+
+        if pending:
+            if not testing:
+                conn.commit() # Claims are durable before any send starts
+
+            futures = {executor.submit(send_message, record, message_type): record for record, message_type in pending}
+            not_done = set(futures)
+            while not_done:
+                done, not_done = concurrent.futures.wait(not_done, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done: # Archive on this thread as results come back
+                    if future.cancelled():
+                        continue
+
+                    record = futures[future]
+                    success = future.result()
+
+                    if success:
+                        success_count += 1
+                    else:
+                        failed_count += 1
+
+                    if record.get("suppress_reason"):
+                        suppress_address(cursor,record["DestinationAddress"],record["suppress_reason"])
+
+                    archived = False
+                    if success or record["attempts"] >= MAX_ATTEMPTS or record.get("suppress_reason"):
+                        archived = finalize_record(cursor,record,success)
+
+                    if not testing:
+                        conn.commit()
+                        if archived:
+                            journal_done([record["ID"]])
+
+                if should_terminate:
+                    for future in not_done:
+                        if future.cancel(): # Queued but not started
+                            unsent_ids.append(futures[future]["ID"])
+
+                    if time.monotonic() > drain_deadline:
+                        stranded = [futures[f]["ID"] for f in not_done if not f.cancelled()]
+                        if stranded: # May still be delivered. Leave leased for the MAX_AGE orphan window
+                            logging.warning(f"Drain deadline passed with {len(stranded)} sends in flight: {stranded}")
+                            stranded_ids.extend(stranded)
+                        break
+
+            if testing:
+                conn.rollback()
 
         if testing and debug_mode:
             logging.debug("Test mode enabled. No database changes made")
@@ -180,8 +520,15 @@ def process_records():
         if cursor:
             cursor.close()
 
+    flush_archive_buffer()
     return success_count, failed_count, skipped_count
 
+def send_message(record, message_type):
+    if message_type == 'sms':
+        return send_sms(record)
+    elif message_type == 'email':
+        return send_email(record)
+
 def validate_message(record):
     destination = record["DestinationAddress"]
     target = destination.strip().split('@')[0]
@@ -196,6 +543,292 @@ def validate_message(record):
 
     return message_type, result
 
+def gsm7_transliterate(text):
+    result = []
+    for char in text:
+        if char in GSM7_BASIC_CHARS or char in GSM7_EXTENDED_CHARS:
+            result.append(char)
+        elif char in GSM7_TRANSLITERATIONS:
+            result.append(GSM7_TRANSLITERATIONS[char])
+        else:
+            # Canonical decomposition only, then drop the accents: á -> a. Compatibility forms like ½ ² ﬁ keep their meaning in UCS-2
+            letters = "".join(c for c in unicodedata.normalize("NFD", char) if not unicodedata.combining(c))
+            if not letters or not all(c in GSM7_BASIC_CHARS or c in GSM7_EXTENDED_CHARS for c in letters):
+                return text # Genuinely needs UCS-2. Leave the text as the sender wrote it
+            result.append(letters)
+    return "".join(result)
+
+def sms_char_units(text):
+    if all(c in GSM7_BASIC_CHARS or c in GSM7_EXTENDED_CHARS for c in text):
+        return "GSM-7", [2 if c in GSM7_EXTENDED_CHARS else 1 for c in text], 160, 153
+    return "UCS-2", [2 if ord(c) > 0xFFFF else 1 for c in text], 70, 67 # Surrogate pairs use two UTF-16 units
+
+def sms_segment_count(units, single, multi):
+    if sum(units) <= single:
+        return 1
+    segments, used = 1, 0
+    for unit in units: # A character never straddles two segments
+        if used + unit > multi:
+            segments += 1
+            used = 0
+        used += unit
+    return segments
+
+def build_sms_body(subject, body, device=False):
+    prefix = f"SUBJ:{subject}\nMSG:" if device else ""
+    msg = gsm7_transliterate(prefix + body)
+    encoding, units, single, multi = sms_char_units(msg)
+    segments = sms_segment_count(units, single, multi)
+    truncated = False
+
+    if segments > max_segments:
+        ellipsis = "..." if encoding == "GSM-7" else "…"
+        budget = (single if max_segments == 1 else max_segments * multi) - len(ellipsis)
+        keep, used = 0, 0
+        for unit in units:
+            if used + unit > budget:
+                break
+            used += unit
+            keep += 1
+        cut = msg.rfind(" ", 0, keep)
+        if cut > keep - 20 and cut > len(prefix): # Prefer a word boundary when one is close
+            keep = cut
+        while True: # Characters never straddle segments, so the unit budget can overshoot. Shrink until the packing fits
+            candidate = msg[:keep].rstrip() + ellipsis
+            encoding, units, single, multi = sms_char_units(candidate)
+            segments = sms_segment_count(units, single, multi)
+            if segments <= max_segments or keep == 0:
+                break
+            keep -= 1
+        msg = candidate
+        truncated = True
+
+    return msg, encoding, segments, truncated
+
+def log_metrics(force=False):
+    global last_metrics_log
+    now = time.monotonic()
+    if not force and now - last_metrics_log < METRICS_INTERVAL:
+        return
+    last_metrics_log = now
+    sent = metrics["sms_sent"]
+    per_message = metrics["sms_segments"] / sent if sent else 0.0
+    values = " ".join(f"{k}={v}" for k, v in metrics.items())
+    logging.info(f"Metrics: {values} sms_segments_per_message={per_message:.2f}")
+
+def initialize_sms_senders():
+    global sms_senders
+    if my_twilio_messaging_service_sid: # Twilio picks the number and keeps sticky sender within the service
+        sms_senders = [my_twilio_messaging_service_sid.strip()]
+    elif my_twilio_phone_numbers:
+        sms_senders = [n.strip() for n in my_twilio_phone_numbers.split(',') if n.strip()]
+    else:
+        sms_senders = [my_twilio_phone_number]
+
+    if debug_mode:
+        logging.debug(f"SMS sender pool: {sms_senders}")
+
+def select_sms_sender(target_phone_number):
+    digits = re.sub(r"\D","",target_phone_number)[-10:] # Same recipient always maps to the same sender
+    return sms_senders[zlib.crc32(digits.encode()) % len(sms_senders)]
+
+def sender_params(sender):
+    if sender and sender.startswith("MG"):
+        return {"messaging_service_sid": sender}
+    return {"from_": sender}
+
+def reserve_sender_slot(sender):
+    rate = sender_rate / shard_count # Every --shards worker drives the same numbers, so each gets an equal share
+    if sender and sender.startswith("MG") and my_twilio_messaging_service_size:
+        rate *= int(my_twilio_messaging_service_size) # Service budget is shared by all of its numbers
+
+    with sender_lock:
+        now = time.monotonic()
+        slot = max(now, sender_next_slot.get(sender, now))
+        sender_next_slot[sender] = slot + 1.0 / rate
+    return slot - now
+
+class ProviderSkip(Exception):
+    pass # Provider can't carry this message. Try the next one without counting it against the provider
+
+def provider_order(channel):
+    names = sms_providers if channel == 'sms' else email_providers
+    now = time.monotonic()
+    with sender_lock:
+        benched = {name for name in names if provider_health.get((channel, name), (0, 0.0))[1] > now}
+    return [name for name in names if name not in benched] + [name for name in names if name in benched] # Benched providers are a last resort
+
+def record_provider_result(channel, name, success):
+    with sender_lock:
+        if success:
+            provider_health[(channel, name)] = (0, 0.0)
+            return
+
+        metrics["provider_failures"] += 1
+        failures, benched_until = provider_health.get((channel, name), (0, 0.0))
+        failures += 1
+        now = time.monotonic()
+        if failures >= PROVIDER_FAILURE_LIMIT: # Benched again on the first failure after the cool-down
+            if benched_until <= now:
+                logging.warning(f"{channel} provider {name} failed {failures} times in a row. Moving it to the back for {PROVIDER_COOLDOWN}s")
+            benched_until = now + PROVIDER_COOLDOWN
+        provider_health[(channel, name)] = (failures, benched_until)
+
+def send_with_failover(channel, record, *args):
+    if journaled_send(record):
+        return True
+
+    order = provider_order(channel)
+    for name in order:
+        try:
+            PROVIDERS[channel][name](record, *args)
+        except ProviderSkip as e:
+            if debug_mode:
+                logging.debug(f'{channel} provider {name} skipped record id {record["ID"]}: {e}')
+            continue
+        except Exception as e:
+            logging.exception(f'Error in {channel} provider {name} for record id {record["ID"]}: {e}')
+            if record.get("suppress_reason"): # Recipient problem. Another provider won't fix it
+                return False
+            record_provider_result(channel, name, False)
+            continue
+
+        record_provider_result(channel, name, True)
+        record["provider_sent_at"] = datetime.datetime.now(datetime.timezone.utc)
+        journal_send(record)
+        if name != order[0]:
+            with sender_lock:
+                metrics["failovers"] += 1
+        if debug_mode:
+            logging.debug(f'Record id {record["ID"]} sent by {channel} provider {name}')
+        return True
+    return False
+
+def send_smtp(record, message):
+    import smtplib
+
+    message["Message-ID"] = f"<acs-{idempotency_key(record)}@{EMAIL_SENDER.split('@')[1]}>" # Same attempt, same id. Lets relays drop a duplicate
+    with smtplib.SMTP(smtp_host, smtp_port, timeout=SMTP_TIMEOUT) as smtp:
+        if smtp_user:
+            smtp.starttls()
+            smtp.login(smtp_user, smtp_password)
+        smtp.send_message(message) # Delivers to To, Cc and Bcc and strips the Bcc header
+    record["provider_message_id"] = message["Message-ID"]
+
+def sms_via_twilio(record, target_phone_number, msg, domain):
+    sender = select_sms_sender(target_phone_number)
+    delay = reserve_sender_slot(sender)
+    if delay > 0:
+        if debug_mode:
+            logging.debug(f"Sender {sender} rate budget exhausted. Waiting {delay:.2f}s")
+        time.sleep(delay)
+
+    try:
+        message = get_sms_client().messages.create(
+            to = target_phone_number,  # Replace with the recipient"s phone number
+            body = msg,
+            **sender_params(sender)
+        )
+    except Exception as e:
+        code = getattr(e, "code", None) # TwilioRestException
+        if code in TWILIO_SUPPRESSION_CODES:
+            record["suppress_reason"] = f"twilio {code} {TWILIO_SUPPRESSION_CODES[code]}"
+        raise
+
+    if debug_mode:
+        logging.debug(f"Message to {target_phone_number} from {sender}")
+        logging.debug(f"Body: {msg}")
+        logging.debug(f"Status: {message.status}")
+
+    record["provider_message_id"] = message.sid
+
+    if message.error_code:
+        raise Exception(f"SMS error {message.error_code} {message.error_message}")
+
+def sms_via_gateway(record, target_phone_number, msg, domain):
+    from email.message import EmailMessage
+
+    domain = domain or sms_gateway_domain
+    if not domain:
+        raise ProviderSkip("no carrier gateway domain for the number")
+
+    message = EmailMessage()
+    message["From"] = EMAIL_SENDER
+    message["To"] = f"{target_phone_number[-10:]}@{domain}"
+    message.set_content(msg)
+    send_smtp(record, message)
+
+def email_via_sendgrid(record, recipient, cc_list, bcc_list, attachment):
+    from sendgrid.helpers.mail import Mail, Personalization, To, Cc, Bcc, Attachment, FileContent, FileName, FileType, Disposition, CustomArg, Header
+
+    mail = Mail(
+        from_email = EMAIL_SENDER,
+        subject = record["Subject"],
+        plain_text_content = record["Body"]
+    )
+    personalization = Personalization()
+    personalization.add_to(To(recipient))
+    for cc in cc_list:
+        personalization.add_cc(Cc(cc))
+    for bcc in bcc_list:
+        personalization.add_bcc(Bcc(bcc))
+    mail.add_personalization(personalization)
+    mail.add_custom_arg(CustomArg("idempotency_key", idempotency_key(record))) # Echoed back on SendGrid events
+    mail.add_header(Header("X-Idempotency-Key", idempotency_key(record)))
+
+    if attachment:
+        name, content = attachment
+        file_name = FileName(name)
+        file_content = FileContent(base64.b64encode(content).decode('utf-8'))
+        file_type = FileType("text/csv")
+        disposition = Disposition("attachment")
+        mail.add_attachment(Attachment(file_content,file_name,file_type,disposition))
+
+    response = get_sendgrid_client().client.mail.send.post(request_body = mail.get())
+
+    if debug_mode:
+        import pprint
+        logging.debug("Email Payload")
+        pprint.pprint(mail.get(), indent=4)
+        logging.debug(f"Email response code: {response.status_code}")
+
+    record["provider_message_id"] = response.headers.get("X-Message-Id") if response.headers else None
+
+    if response.status_code < 200 or response.status_code > 204:
+        logging.debug(response.to_dict)
+        raise Exception(f"Email request failed with code {response.status_code}")
+
+def email_via_smtp(record, recipient, cc_list, bcc_list, attachment):
+    from email.message import EmailMessage
+
+    message = EmailMessage()
+    message["From"] = EMAIL_SENDER
+    message["To"] = recipient
+    if cc_list:
+        message["Cc"] = ", ".join(cc_list)
+    if bcc_list:
+        message["Bcc"] = ", ".join(bcc_list)
+    message["Subject"] = record["Subject"]
+    message.set_content(record["Body"])
+
+    if attachment:
+        name, content = attachment
+        message.add_attachment(content, maintype="text", subtype="csv", filename=name)
+    send_smtp(record, message)
+
+def stub_send(record, *args): # Stand-in provider for local runs. Always succeeds
+    record["provider_message_id"] = f'stub-{record["ID"]}-{record["attempts"]}'
+    logging.info(f'Stub provider accepted record id {record["ID"]} for {record["DestinationAddress"]}')
+
+def fail_send(record, *args): # Stand-in provider that is always down. Exercises failover
+    raise Exception("fail provider is always down")
+
+# --sms-providers / --email-providers names. Each is called with the record and the channel's payload and raises on failure
+PROVIDERS = {
+    'sms': {"twilio": sms_via_twilio, "gateway": sms_via_gateway, "stub": stub_send, "fail": fail_send},
+    'email': {"sendgrid": email_via_sendgrid, "smtp": email_via_smtp, "stub": stub_send, "fail": fail_send},
+}
+
 def send_sms(record):
     try:
         if phone_override is not None:
@@ -206,99 +839,239 @@ def send_sms(record):
         domain = destination[1] if len(destination) > 1 else None
         subject = record["Subject"].strip()
         body = record["Body"].strip()
-        msg = None
+        msg, encoding, segments, truncated = build_sms_body(subject, body, domain == 'txt.att.net') # txt.att.net is a device
 
-        if domain == 'txt.att.net': # It's a device
-            msg = f"SUBJ:{subject}\nMSG:{body}"
-        else:
-            msg = body
+        if debug_mode:
+            logging.debug(f"SMS to {target_phone_number}: {segments} {encoding} segment(s){' (truncated)' if truncated else ''}")
 
         if no_notify is True:
             logging.debug(f"Notifications disabled. No messages will be sent to {target_phone_number}")
             return True # pretend like it worked
 
-        message = sms_client.messages.create(
-            to = target_phone_number,  # Replace with the recipient"s phone number
-            from_ = my_twilio_phone_number,  # Replace with your Twilio phone number
-            body = msg,
-        )
-
-        if debug_mode:
-            logging.debug(f"Message to {target_phone_number}")
-            logging.debug(f"Body: {msg}")
-            logging.debug(f"Status: {message.status}")
+        if not send_with_failover('sms', record, target_phone_number, msg, domain):
+            return False
 
-        if message.error_code:
-            raise Exception(f"SMS error {message.error_code} {message.error_message}")
+        with sender_lock:
+            metrics["sms_sent"] += 1
+            metrics["sms_segments"] += segments
+            metrics["sms_ucs2"] += encoding == "UCS-2"
+            metrics["sms_truncated"] += truncated
     except Exception as e:
         logging.exception(f"Error in send_sms: {e}")
         return False
     return True
 
+def email_addresses(addresses, label):
+    valid = []
+    if addresses is not None:
+        for address in addresses.strip().split(','):
+            val = address.strip()
+            if not re.fullmatch(r"[^@]+@[^@]+\.[^@]+",val):
+                logging.error(f"Ignoring malformed {label} recipient ({val})")
+                continue
+            valid.append(val)
+    return valid
+
 def send_email(record):
     try:
         if email_override:
             record["DestinationAddress"] = email_override
 
         recipient = record["DestinationAddress"]
-        sender = record["SourceAddress"]
-        sender = 'bamsupport@airgas-rd.com' # override until mail.airgas-rd.com is validated with twilio
-        mail = Mail(
-            from_email = sender,
-            subject = record["Subject"],
-            plain_text_content = record["Body"]
-        )
-        personalization = Personalization()
-        personalization.add_to(To(recipient))
-
-        if record["CC_Address"] is not None and len(record["CC_Address"].strip().split(',')) > 0:
-            cc_list = record["CC_Address"].strip().split(',')
-            for cc in cc_list:
-                val = cc.strip()
-                if not re.fullmatch(r"[^@]+@[^@]+\.[^@]+",val):
-                    logging.error(f"Ignoring malformed CC recipient ({val})")
-                    continue
-                personalization.add_cc(Cc(val))
-
-        if record["BCC_Address"] is not None and len(record["BCC_Address"].strip().split(',')) > 0:
-            bcc_list = record["BCC_Address"].strip().split(',')
-            for bcc in bcc_list:
-                val = bcc.strip()
-                if not re.fullmatch(r"[^@]+@[^@]+\.[^@]+",val):
-                    logging.error(f"Ignoring malformed BCC recipient ({val})")
-                    continue
-                personalization.add_bcc(Bcc(val))
+        cc_list = email_addresses(record["CC_Address"], "CC")
+        bcc_list = email_addresses(record["BCC_Address"], "BCC")
 
-        mail.add_personalization(personalization)
+        attachment = None
         if record["Attachment"] and len(record["Attachment"]) > 0:
             basename = re.sub(r'[^\w\-_.]', '_', record["Subject"].strip().lower()) # acs_report_name
             suffix = datetime.datetime.now(datetime.timezone.utc).strftime("_%Y_%m_%d_%H_%M_%S.csv")
-            name = basename + suffix # acs_report_name_YYYY_mm_dd_HH_MM_SS.csv
-            file_name = FileName(name)
-            file_content = FileContent(base64.b64encode(record["Attachment"]).decode('utf-8'))
-            file_type = FileType("text/csv")
-            disposition = Disposition("attachment")
-            attachment = Attachment(file_content,file_name,file_type,disposition)
-            mail.add_attachment(attachment)
+            attachment = (basename + suffix, bytes(record["Attachment"])) # acs_report_name_YYYY_mm_dd_HH_MM_SS.csv
 
         if no_notify is True:
             logging.debug(f"Notifications disabled. No messages will be sent to {recipient}")
             return True # pretend like it worked
 
-        response = sg.client.mail.send.post(request_body = mail.get())
-
-        if debug_mode:
-            logging.debug("Email Payload")
-            pprint.pprint(mail.get(), indent=4)
-            logging.debug(f"Email response code: {response.status_code}")
-
-        if response.status_code < 200 or response.status_code > 204:
-            logging.debug(response.to_dict)
-            raise Exception(f"Email request failed with code {response.status_code}")
+        return send_with_failover('email', record, recipient, cc_list, bcc_list, attachment)
     except Exception as e:
         logging.exception(f"Error in send_email: {e}")
         return False
-    return True
+
+def suppression_key(address):
+    address = address.strip().lower()
+    target = re.sub(r"[\(\)\s\-\+]","",address.split('@')[0])
+    if re.fullmatch(r"\d{10,11}", target):
+        return target[-10:] # Same number with or without country code or carrier domain
+    return address
+
+def refresh_suppressions(cursor):
+    global suppressed_addresses, suppressions_loaded_at
+    if suppressions_loaded_at is not None and time.monotonic() - suppressions_loaded_at < SUPPRESSION_TTL:
+        return
+    suppressions_loaded_at = time.monotonic() # A broken source is retried after the TTL, not every cycle
+
+    addresses = set()
+    try:
+        cursor.execute('SELECT address FROM mail."SuppressedAddress";')
+        addresses.update(suppression_key(row["address"]) for row in cursor.fetchall())
+        conn.commit()
+    except psycopg2.Error as e:
+        logging.error(f"Could not load suppression table: {e}")
+        conn.rollback()
+        addresses.update(suppressed_addresses) # Keep what we had
+
+    if suppression_file:
+        try:
+            with open(suppression_file) as f:
+                addresses.update(suppression_key(line) for line in f if line.strip() and not line.startswith('#'))
+        except OSError as e:
+            logging.error(f"Could not read suppression file {suppression_file}: {e}")
+
+    suppressed_addresses = addresses
+    if debug_mode:
+        logging.debug(f"Loaded {len(addresses)} suppressed addresses")
+
+def is_suppressed(record):
+    return suppression_key(record["DestinationAddress"]) in suppressed_addresses
+
+def suppress_address(cursor,address,reason):
+    key = suppression_key(address)
+    suppressed_addresses.add(key)
+    try:
+        insert_sql = 'INSERT INTO mail."SuppressedAddress" (address, reason, source) VALUES (%s,%s,%s) ON CONFLICT (address) DO NOTHING;'
+        params = (key, reason, my_process_identifier)
+
+        if debug_mode:
+            logging.debug(cursor.mogrify(insert_sql,params).decode())
+
+        cursor.execute(insert_sql,params)
+    except psycopg2.Error as e:
+        logging.exception(f"Error suppressing {key}: {e}")
+
+def sync_suppressions():
+    client = get_sendgrid_client()
+    rows = []
+    for kind in SENDGRID_SUPPRESSION_LISTS:
+        offset = 0
+        while True:
+            response = getattr(client.client.suppression, kind).get(query_params={"limit": 500, "offset": offset})
+            entries = json.loads(response.body)
+            rows.extend((suppression_key(e["email"]), f"sendgrid {kind} {e.get('reason') or ''}".strip(), "sendgrid") for e in entries)
+            if len(entries) < 500:
+                break
+            offset += 500
+
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        insert_sql = 'INSERT INTO mail."SuppressedAddress" (address, reason, source) VALUES %s ON CONFLICT (address) DO NOTHING;'
+        execute_values(cursor, insert_sql, rows, page_size=500)
+
+        if testing:
+            conn.rollback()
+        else:
+            conn.commit()
+        logging.info(f"Synced {len(rows)} SendGrid suppressions")
+    except psycopg2.Error as e:
+        logging.exception(f"Suppression sync failed: {e}")
+        conn.rollback()
+        sys.exit(1)
+    finally:
+        if cursor:
+            cursor.close()
+
+def release_claimed_rows():
+    # Hand this worker's rows back so peers pick them up next cycle instead of after MAX_AGE
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        release_sql = """
+        UPDATE mail."MailQueue"
+        SET processed_by = NULL, attempts = attempts - CASE WHEN "ID" = ANY(%s) THEN 1 ELSE 0 END -- Never sent. Don't count the attempt
+        WHERE processed_by = %s
+          AND NOT ("ID" = ANY(%s)) -- Still buffered, mid-send, or sent and journaled but not yet archived
+        """
+        params = (unsent_ids, my_process_identifier, buffered_ids() + stranded_ids + list(journal_entries))
+
+        if debug_mode:
+            logging.debug(cursor.mogrify(release_sql,params).decode())
+
+        cursor.execute(release_sql,params)
+        released = cursor.rowcount
+
+        if testing:
+            conn.rollback()
+        else:
+            conn.commit()
+        logging.info(f"Released {released} claimed records")
+    except psycopg2.Error as e:
+        logging.exception(f"Error releasing claimed records: {e}")
+        conn.rollback()
+    finally:
+        if cursor:
+            cursor.close()
+
+def finalize_record(cursor,record,success):
+    global archive_buffer_started
+    if not write_behind:
+        return archive_record(cursor,record,success)
+
+    # The row stays in MailQueue, leased to this worker, until the flush commits
+    if not archive_buffer:
+        archive_buffer_started = time.monotonic()
+    archive_buffer.append((record, success, datetime.datetime.now(datetime.timezone.utc)))
+
+def buffered_ids():
+    return [record["ID"] for record, _, _ in archive_buffer]
+
+def flush_archive_buffer(force=False):
+    if not archive_buffer:
+        return
+    if not force and len(archive_buffer) < ARCHIVE_FLUSH_SIZE and time.monotonic() - archive_buffer_started < ARCHIVE_FLUSH_SECONDS:
+        return
+
+    batch = archive_buffer[:]
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        delete_sql = 'DELETE FROM mail."MailQueue" WHERE "ID" = ANY(%s) AND processed_by = %s RETURNING "ID";'
+        params = ([record["ID"] for record, _, _ in batch], my_process_identifier)
+
+        if debug_mode:
+            logging.debug(cursor.mogrify(delete_sql,params).decode())
+
+        cursor.execute(delete_sql,params)
+        owned = {row["ID"] for row in cursor.fetchall()} # Rows taken over by another worker are theirs to archive
+
+        for success in (True, False):
+            table = 'mail."MailArchive"' if success else 'mail."FailedMail"'
+            rows = [
+                (r["DestinationAddress"],r["SourceAddress"],r["CC_Address"],r["BCC_Address"],r["Subject"],r["Body"],r["processed_by"],sent_at,
+                 r.get("created_at"),r.get("claimed_at"),r.get("provider_sent_at"),r.get("provider_message_id"))
+                for r, ok, sent_at in batch if ok == success and r["ID"] in owned
+            ]
+            if not rows:
+                continue
+
+            insert_sql = f"INSERT INTO {table}\n"
+            insert_sql += '("DestinationAddress","SourceAddress","CC_Address","BCC_Address","Subject","Body",processed_by,"DateSent",created_at,claimed_at,provider_sent_at,provider_message_id)\n'
+            insert_sql += 'VALUES %s;'
+            execute_values(cursor, insert_sql, rows, page_size=ARCHIVE_FLUSH_SIZE)
+
+        if testing:
+            conn.rollback()
+        else:
+            conn.commit()
+        del archive_buffer[:len(batch)]
+        journal_done([record["ID"] for record, _, _ in batch])
+
+        if debug_mode:
+            logging.debug(f"Flushed {len(owned)} of {len(batch)} buffered archive records")
+    except psycopg2.Error as e:
+        logging.exception(f"Error flushing archive buffer ({len(batch)} records): {e}") # Rows stay leased. Retried on the next flush
+        conn.rollback()
+    finally:
+        if cursor:
+            cursor.close()
 
 def archive_record(cursor,record,success):
     id = record["ID"]
@@ -309,6 +1082,10 @@ def archive_record(cursor,record,success):
     subject = record["Subject"]
     body = record["Body"]
     processed_by = record["processed_by"]
+    created_at = record.get("created_at")
+    claimed_at = record.get("claimed_at")
+    provider_sent_at = record.get("provider_sent_at")
+    provider_message_id = record.get("provider_message_id")
     table = 'mail."MailArchive"' if success else 'mail."FailedMail"'
 
     try:
@@ -321,9 +1098,9 @@ def archive_record(cursor,record,success):
         cursor.execute(delete_sql,params)
 
         insert_sql = f"INSERT INTO {table}\n"
-        insert_sql += f'("DestinationAddress","SourceAddress","CC_Address","BCC_Address","Subject","Body",processed_by,"DateSent")\n'
-        insert_sql += 'VALUES (%s,%s,%s,%s,%s,%s,%s,NOW());'
-        params = (destination,source,cc,bcc,subject,body,processed_by) # discard attachments after sending
+        insert_sql += f'("DestinationAddress","SourceAddress","CC_Address","BCC_Address","Subject","Body",processed_by,"DateSent",created_at,claimed_at,provider_sent_at,provider_message_id)\n'
+        insert_sql += 'VALUES (%s,%s,%s,%s,%s,%s,%s,NOW(),%s,%s,%s,%s);'
+        params = (destination,source,cc,bcc,subject,body,processed_by,created_at,claimed_at,provider_sent_at,provider_message_id) # discard attachments after sending
 
         if debug_mode:
             logging.debug(cursor.mogrify(insert_sql,params).decode())
@@ -331,9 +1108,379 @@ def archive_record(cursor,record,success):
         cursor.execute(insert_sql,params)
     except psycopg2.Error as e:
         logging.exception(f'Error archiving {record["ID"]}: {e}')
+        return False
+    return True
+
+def idempotency_key(record):
+    return f'{record["ID"]}-{record["attempts"]}' # attempts goes up on every claim, so a retry gets a new key
+
+def journal_write(entry, sync=False):
+    global journal_lines
+    journal_file.write(json.dumps(entry) + "\n")
+    journal_file.flush()
+    if sync:
+        os.fsync(journal_file.fileno())
+    journal_lines += 1
+
+def journal_send(record):
+    if journal_file is None: # --testing
+        return
+    entry = {"id": record["ID"], "key": idempotency_key(record), "sid": record.get("provider_message_id"),
+             "sent_at": record["provider_sent_at"].isoformat()}
+    with journal_lock:
+        journal_write(entry, sync=True) # On disk before the archive commit can start
+        journal_entries[record["ID"]] = entry
+
+def journal_done(ids):
+    if journal_file is None:
+        return
+    with journal_lock:
+        for id in ids:
+            entry = journal_entries.pop(id, None)
+            if entry:
+                journal_write({"id": id, "done": entry["key"]}) # Losing one of these only costs a no-op reconcile
+        if journal_lines >= JOURNAL_COMPACT_LINES:
+            compact_journal()
+
+def journaled_send(record):
+    entry = journal_entries.get(record["ID"])
+    if entry is None:
+        return False
+    # Sent on an earlier claim whose archive never committed. Archive it with that send's provider id
+    record["provider_message_id"] = entry["sid"]
+    record["provider_sent_at"] = datetime.datetime.fromisoformat(entry["sent_at"])
+    logging.warning(f'Record id {record["ID"]} was already sent as {entry["key"]} ({entry["sid"]}). Not sending again')
+    return True
+
+def compact_journal():
+    global journal_file, journal_lines
+    path = os.path.join(log_dir, f"{my_process_identifier}.journal")
+    with open(path + ".tmp", "w") as f:
+        for entry in journal_entries.values():
+            f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    if journal_file:
+        journal_file.close()
+    os.replace(path + ".tmp", path)
+    journal_file = open(path, "a")
+    journal_lines = len(journal_entries)
+
+def open_journal():
+    path = os.path.join(log_dir, f"{my_process_identifier}.journal")
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # Torn last line from a crash mid-write
+                    continue
+                if "done" not in entry:
+                    journal_entries[entry["id"]] = entry
+                elif journal_entries.get(entry["id"], {}).get("key") == entry["done"]:
+                    del journal_entries[entry["id"]]
+    compact_journal()
+
+def reconcile_journal():
+    if not journal_entries:
+        return
+
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT "ID" FROM mail."MailQueue" WHERE "ID" = ANY(%s)', (list(journal_entries),))
+        queued = {row["ID"] for row in cursor.fetchall()}
+        done = [id for id in journal_entries if id not in queued] # Archived before the crash
+
+        select_sql = """
+        SELECT "ID", "DestinationAddress", "SourceAddress", "CC_Address", "BCC_Address", "Subject", "Body", attempts, processed_by, created_at, claimed_at
+        FROM mail."MailQueue"
+        WHERE "ID" = ANY(%s)
+          AND processed_by = %s -- A peer that took it over after MAX_AGE owns it now
+        FOR UPDATE SKIP LOCKED
+        """
+        params = (list(journal_entries), my_process_identifier)
+
+        if debug_mode:
+            logging.debug(cursor.mogrify(select_sql,params).decode())
+
+        cursor.execute(select_sql,params)
+        archived = []
+        for row in cursor.fetchall():
+            record = dict(row)
+            journaled_send(record)
+            if not archive_record(cursor,record,True):
+                archived = [] # The transaction is aborted. Nothing in it commits
+                break
+            archived.append(record["ID"])
+
+        if archived:
+            conn.commit()
+        else:
+            conn.rollback()
+        logging.info(f"Reconciled {len(archived)} of {len(journal_entries)} journaled sends")
+        journal_done(done + archived) # Locked, failed or peer owned rows stay open. Claims of them skip the send
+    except psycopg2.Error as e:
+        logging.exception(f"Error reconciling the send journal: {e}") # Entries stay open. Claims of these rows skip the send
+        conn.rollback()
+    finally:
+        if cursor:
+            cursor.close()
+
+def month_start(day, offset=0):
+    month = day.month - 1 + offset
+    return datetime.date(day.year + month // 12, month % 12 + 1, 1)
+
+def run_ddl(cursor, sql): # DDL can't take bind parameters. Only ever fed our own dates and names
+    if debug_mode:
+        logging.debug(sql)
+    cursor.execute(sql)
+
+def prepare_partition_conversion(cursor, table, boundary):
+    # Each step is its own short transaction and none of them blocks inserts for long
+    run_ddl(cursor, f'CREATE TABLE IF NOT EXISTS mail."{table}_undated" (LIKE mail."{table}")')
+    cursor.execute(f'WITH moved AS (DELETE FROM mail."{table}" WHERE "DateSent" IS NULL RETURNING *) INSERT INTO mail."{table}_undated" SELECT * FROM moved')
+    run_ddl(cursor, f'ALTER TABLE mail."{table}" DROP CONSTRAINT IF EXISTS "{table}_legacy_bound"')
+    run_ddl(cursor, f"""ALTER TABLE mail."{table}" ADD CONSTRAINT "{table}_legacy_bound" CHECK ("DateSent" IS NOT NULL AND "DateSent" < '{boundary}') NOT VALID""")
+    conn.commit()
+    run_ddl(cursor, f'ALTER TABLE mail."{table}" VALIDATE CONSTRAINT "{table}_legacy_bound"') # Scans under a lock that still allows inserts
+    conn.commit()
+
+    cursor.execute("""
+    SELECT i.relname, pg_get_indexdef(x.indexrelid) AS definition
+    FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    WHERE x.indrelid = format('mail.%%I', %s)::regclass AND x.indisunique
+    """, (table,))
+    rows = cursor.fetchall()
+    conn.commit()
+    conn.autocommit = True # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    try:
+        for row in rows: # Plain twin of each unique index, the shape the parent will have, so ATTACH adopts it instead of building one
+            definition = re.sub(r"^CREATE UNIQUE INDEX \S+", f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{row["relname"]}_part"', row["definition"])
+            run_ddl(cursor, definition)
+    finally:
+        conn.autocommit = False
+
+def convert_to_partitioned(cursor, table, boundary):
+    cursor.execute("""
+    SELECT c.relkind
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'mail' AND c.relname = %s
+    """, (table,))
+    row = cursor.fetchone()
+    if row is None or row["relkind"] == 'p':
+        return True
+    if testing: # The preparation commits as it goes, so it can't be rolled back
+        logging.warning(f'Test mode enabled. mail."{table}" is not partitioned yet and is left as is')
+        return False
+    prepare_partition_conversion(cursor, table, boundary)
+
+    # One time conversion. Existing rows, including this month's, become a single partition ending at boundary.
+    # Everything slow already ran in prepare_partition_conversion, so the locked part only changes the catalog
+    legacy = f"{table}_legacy"
+    logging.info(f'Converting mail."{table}" to a partitioned table. Existing rows move to mail."{legacy}"')
+    run_ddl(cursor, f'ALTER TABLE mail."{table}" RENAME TO "{legacy}"')
+    run_ddl(cursor, f'CREATE TABLE mail."{table}" (LIKE mail."{legacy}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING IDENTITY INCLUDING STORAGE INCLUDING COMMENTS) PARTITION BY RANGE ("DateSent")')
+
+    cursor.execute("""
+    SELECT attname FROM pg_attribute
+    WHERE attrelid = format('mail.%%I', %s)::regclass AND attidentity <> ''
+    """, (table,))
+    for row in cursor.fetchall(): # The copied identity has a fresh sequence. Carry on from the legacy ids
+        cursor.execute(f"""SELECT setval(pg_get_serial_sequence(format('mail.%%I', %s), %s), COALESCE(max("{row["attname"]}"), 0) + 1, false) FROM mail."{legacy}" """,
+                       (table, row["attname"]))
+
+    run_ddl(cursor, f'CREATE TABLE mail."{table}_default" PARTITION OF mail."{table}" DEFAULT') # Inserts never fail if maintenance stops running
+    cursor.execute(f'INSERT INTO mail."{table}" OVERRIDING SYSTEM VALUE SELECT * FROM mail."{table}_undated"') # NULL keys only fit the default partition
+    run_ddl(cursor, f'DROP TABLE mail."{table}_undated"')
+    run_ddl(cursor, f"""ALTER TABLE mail."{table}" ATTACH PARTITION mail."{legacy}" FOR VALUES FROM (MINVALUE) TO ('{boundary}')""") # The validated bound check lets this skip the scan
+    run_ddl(cursor, f'ALTER TABLE mail."{legacy}" DROP CONSTRAINT "{table}_legacy_bound"')
+
+    cursor.execute("""
+    SELECT i.relname, pg_get_indexdef(x.indexrelid) AS definition, x.indisunique
+    FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    WHERE x.indrelid = format('mail.%%I', %s)::regclass
+    """, (legacy,))
+    for row in cursor.fetchall(): # Created on the parent so every new partition gets them. Legacy already has a matching index that gets attached
+        if row["relname"].endswith("_part"): # Built by prepare_partition_conversion
+            continue
+        run_ddl(cursor, f'ALTER INDEX mail."{row["relname"]}" RENAME TO "{row["relname"]}_legacy"')
+        definition = re.sub(r" ON (ONLY )?\S+ ", f' ON mail."{table}" ', row["definition"], count=1)
+        definition = re.sub(r"^CREATE (UNIQUE )?INDEX \S+", f'CREATE INDEX "{row["relname"]}"', definition)
+        if row["indisunique"]: # Unique indexes on a partitioned table must include "DateSent". Keep the lookup, not the constraint
+            logging.warning(f'mail."{row["relname"]}" is unique. Recreated on mail."{table}" as a plain index')
+        run_ddl(cursor, definition)
+    return True
+
+def manage_partitions():
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        cutoff = month_start(today, -retention_months)
+
+        for table in PARTITIONED_TABLES:
+            if not convert_to_partitioned(cursor, table, month_start(today, 1)):
+                continue
+
+            for offset in range(1, PARTITION_PRECREATE_MONTHS + 1): # This month is covered by the partition created a month ago, or the legacy one
+                start, end = month_start(today, offset), month_start(today, offset + 1)
+                run_ddl(cursor, f"""CREATE TABLE IF NOT EXISTS mail."{table}_y{start:%Y}m{start:%m}" PARTITION OF mail."{table}" FOR VALUES FROM ('{start}') TO ('{end}')""")
+
+            cursor.execute("""
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            JOIN pg_namespace n ON n.oid = p.relnamespace
+            WHERE n.nspname = 'mail' AND p.relname = %s
+            ORDER BY c.relname
+            """, (table,))
+
+            for row in cursor.fetchall():
+                upper = re.search(r"TO \('(\d{4}-\d{2}-\d{2})", row["bound"]) # DEFAULT partition has no bounds
+                if upper is None or datetime.date.fromisoformat(upper.group(1)) > cutoff:
+                    continue
+
+                if drop_expired:
+                    logging.info(f'Dropping expired partition mail."{row["relname"]}"')
+                    run_ddl(cursor, f'ALTER TABLE mail."{table}" DETACH PARTITION mail."{row["relname"]}"')
+                    run_ddl(cursor, f'DROP TABLE mail."{row["relname"]}"')
+                else:
+                    logging.info(f'Detaching expired partition mail."{row["relname"]}"')
+                    run_ddl(cursor, f'ALTER TABLE mail."{table}" DETACH PARTITION mail."{row["relname"]}"')
+
+        if testing:
+            conn.rollback()
+            logging.info("Test mode enabled. Partition changes rolled back")
+        else:
+            conn.commit()
+    except psycopg2.Error as e:
+        logging.exception(f"Partition maintenance failed: {e}")
+        conn.rollback()
+        sys.exit(1)
+    finally:
+        if cursor:
+            cursor.close()
+
+def install_schema():
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        for sql in SCHEMA_SQL:
+            run_ddl(cursor, sql)
+
+        if testing:
+            conn.rollback()
+            logging.info("Test mode enabled. Schema changes rolled back")
+        else:
+            conn.commit()
+            logging.info(f"Applied {len(SCHEMA_SQL)} schema statements")
+    except psycopg2.Error as e:
+        logging.exception(f"Schema install failed: {e}")
+        conn.rollback()
+        sys.exit(1)
+    finally:
+        if cursor:
+            cursor.close()
+
+def format_percentiles(values):
+    if not values or values[0] is None:
+        return "-"
+    return "/".join(f"{v:.2f}" for v in values) + "s"
+
+def lag_report():
+    report_sql = """
+    SELECT mode, processed_by, count(*) AS messages,
+           percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY queue_lag) AS queue_lag,
+           percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY send_latency) AS send_latency
+    FROM (
+        SELECT COALESCE(substring(processed_by from '-(report|notification)(-|$)'), 'all') AS mode,
+               processed_by,
+               EXTRACT(EPOCH FROM claimed_at - created_at) AS queue_lag,
+               EXTRACT(EPOCH FROM provider_sent_at - claimed_at) AS send_latency
+        FROM mail."MailArchive"
+        WHERE "DateSent" >= COALESCE(%s::timestamptz, NOW() - '1 day'::interval)
+          AND "DateSent" < COALESCE(%s::timestamptz, NOW())
+          AND claimed_at IS NOT NULL
+    ) sent
+    GROUP BY GROUPING SETS ((mode), (mode, processed_by))
+    ORDER BY mode, processed_by NULLS FIRST
+    """
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        params = (report_since, report_until)
+        if debug_mode:
+            logging.debug(cursor.mogrify(report_sql,params).decode())
+
+        cursor.execute(report_sql,params)
+        rows = cursor.fetchall()
+        conn.rollback()
+
+        print(f"{'mode':<14}{'worker':<40}{'messages':>10}  {'queue lag p50/p95/p99':<26}send latency p50/p95/p99")
+        for row in rows:
+            worker = row["processed_by"] or "(all workers)"
+            print(f"{row['mode']:<14}{worker:<40}{row['messages']:>10}  {format_percentiles(row['queue_lag']):<26}{format_percentiles(row['send_latency'])}")
+    except psycopg2.Error as e:
+        logging.exception(f"Lag report failed: {e}")
+        conn.rollback()
+        sys.exit(1)
+    finally:
+        if cursor:
+            cursor.close()
+
+def plan_nodes(plan, depth=0):
+    yield depth, plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child, depth + 1)
+
+def report_claim_plan(plan):
+    seq_scans = []
+    for depth, node in plan_nodes(plan):
+        relation = f' on {node["Relation Name"]}' if "Relation Name" in node else ""
+        index = f' using {node["Index Name"]}' if "Index Name" in node else ""
+        print(f'{"  " * depth}{node["Node Type"]}{relation}{index} '
+              f'(rows={node.get("Actual Rows")} time={node.get("Actual Total Time")}ms '
+              f'shared hit={node.get("Shared Hit Blocks")} read={node.get("Shared Read Blocks")})')
+        if node["Node Type"] == "Seq Scan" and node.get("Relation Name") == "MailQueue":
+            seq_scans.append(node)
+
+    if seq_scans:
+        logging.warning("Claim query sequentially scans MailQueue. Run --install-schema and ANALYZE mail.\"MailQueue\"")
+    return not seq_scans
+
+def explain_claim():
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        shard_filter = f'"ID" %% {shard_count} = {shard_index}' if shard_count > 1 else "TRUE"
+        explain_sql = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)" + build_claim_sql(shard_filter)
+        params = claim_params([])
+
+        if debug_mode:
+            logging.debug(cursor.mogrify(explain_sql,params).decode())
+
+        cursor.execute(explain_sql,params)
+        plan = cursor.fetchone()[0][0]
+        conn.rollback() # ANALYZE really ran the claim. Let go of the row locks
+        print(f'Planning {plan["Planning Time"]}ms, execution {plan["Execution Time"]}ms')
+        if not report_claim_plan(plan["Plan"]):
+            sys.exit(2)
+    except psycopg2.Error as e:
+        logging.exception(f"Explain failed: {e}")
+        conn.rollback()
+        sys.exit(1)
+    finally:
+        if cursor:
+            cursor.close()
 
 def running_process_check():
     global my_process_identifier
+    import psutil
+
     mypid = os.getpid()
     myscriptname = os.path.basename(__file__)
 
@@ -385,17 +1532,48 @@ Options:
   -j, --job-id      Custom job identifier
   -i, --interval    Polling interval (seconds)
   -L, --log-dir     Custom log directory
+      --sender-rate SMS per second per sender number, split evenly across the --shards workers (default: 1)
+      --max-segments Truncate SMS longer than this many segments (default: 4)
+      --write-behind Buffer archive writes and flush them in bulk
+      --partitions  Create/retire monthly MailArchive and FailedMail partitions and exit
+      --retention-months  Months of archive partitions to keep (default: 13)
+      --drop-expired  Drop expired partitions instead of detaching them
+      --install-schema  Add the columns and indexes this version needs and exit
+      --lag-report  Print p50/p95/p99 queue lag and send latency per mode and worker and exit
+      --since, --until  Lag report time range (default: the last 24 hours)
+      --explain     EXPLAIN ANALYZE the claim query for these options, warn on a MailQueue seq scan and exit
+      --shards      Split the queue into N "ID" buckets. Each job id owns one (default: 1)
+      --drain-timeout Seconds in-flight sends get to finish on shutdown (default: 20)
+      --fair        Share each batch across SourceAddress values by weight instead of oldest first
+      --suppression-file  Extra suppressed addresses, one per line
+      --sync-suppressions  Copy SendGrid bounce/block/spam/unsubscribe lists into the suppression table and exit
+      --tuning-file JSON of runtime tuning values. Re-read on SIGHUP
+      --config-table  Poll mail."MessengerConfig" for runtime tuning values
+      --profile     cProfile the first N batches into log_dir. SIGUSR1 toggles a 50 batch profile
+      --workers     Send on a pool of N threads (default: 1, send inline)
+      --sms-providers  SMS failover order (default: $SMS_PROVIDERS or twilio). twilio, gateway, stub, fail
+      --email-providers  Email failover order (default: $EMAIL_PROVIDERS or sendgrid). sendgrid, smtp, stub, fail
   -h, --help        Show this help message and exit
 """)
 
 def parse_args():
     global mode, loop, debug_mode, testing, no_notify, email_override
     global phone_override, job_id, interval, log_dir, my_process_identifier
+    global sender_rate, max_segments, write_behind
+    global command, retention_months, drop_expired, report_since, report_until
+    global fair_queuing, suppression_file, tuning_file, config_table, reload_requested
+    global sms_providers, email_providers
+    global profile_batches, drain_seconds, shard_count, shard_index, workers
 
     try:
         opts, _ = getopt.getopt(sys.argv[1:], "hdtnlm:e:p:j:i:L:", [
             "help", "debug", "testing", "mode=", "no-notify", "loop",
-            "email=", "phone=", "job-id=", "interval=", "log-dir="
+            "email=", "phone=", "job-id=", "interval=", "log-dir=", "sender-rate=",
+            "max-segments=", "write-behind",
+            "partitions", "retention-months=", "drop-expired",
+            "install-schema", "lag-report", "since=", "until=", "explain", "shards=", "drain-timeout=", "fair",
+            "suppression-file=", "sync-suppressions",
+            "tuning-file=", "config-table", "sms-providers=", "email-providers=", "profile=", "workers="
         ])
         for opt, arg in opts:
             if opt in ["-h", "--help"]:
@@ -421,6 +1599,50 @@ def parse_args():
                 interval = float(arg.strip())
             elif opt in ["-L", "--log-dir"]:
                 log_dir = os.path.abspath(arg.strip())
+            elif opt == "--sender-rate":
+                sender_rate = float(arg.strip())
+            elif opt == "--max-segments":
+                max_segments = int(arg.strip())
+            elif opt == "--write-behind":
+                write_behind = True
+            elif opt == "--partitions":
+                command = manage_partitions
+            elif opt == "--retention-months":
+                retention_months = int(arg.strip())
+            elif opt == "--drop-expired":
+                drop_expired = True
+            elif opt == "--install-schema":
+                command = install_schema
+            elif opt == "--lag-report":
+                command = lag_report
+            elif opt == "--since":
+                report_since = arg.strip()
+            elif opt == "--until":
+                report_until = arg.strip()
+            elif opt == "--explain":
+                command = explain_claim
+            elif opt == "--shards":
+                shard_count = int(arg.strip())
+            elif opt == "--drain-timeout":
+                drain_seconds = float(arg.strip())
+            elif opt == "--fair":
+                fair_queuing = True
+            elif opt == "--suppression-file":
+                suppression_file = os.path.abspath(arg.strip())
+            elif opt == "--sync-suppressions":
+                command = sync_suppressions
+            elif opt == "--tuning-file":
+                tuning_file = os.path.abspath(arg.strip())
+            elif opt == "--config-table":
+                config_table = True
+            elif opt == "--sms-providers":
+                sms_providers = [p.strip() for p in arg.split(',')]
+            elif opt == "--email-providers":
+                email_providers = [p.strip() for p in arg.split(',')]
+            elif opt == "--profile":
+                profile_batches = int(arg.strip())
+            elif opt == "--workers":
+                workers = int(arg.strip())
     except getopt.GetoptError as e:
         print(e, file=sys.stderr)
         print_usage()
@@ -431,6 +1653,45 @@ def parse_args():
         print_usage()
         sys.exit(1)
 
+    if sender_rate <= 0:
+        logging.error(f"Invalid sender rate: {sender_rate}")
+        print_usage()
+        sys.exit(1)
+
+    if max_segments < 1:
+        logging.error(f"Invalid max segments: {max_segments}")
+        print_usage()
+        sys.exit(1)
+
+    if retention_months < 1:
+        logging.error(f"Invalid retention months: {retention_months}")
+        print_usage()
+        sys.exit(1)
+
+    if shard_count < 1:
+        logging.error(f"Invalid shard count: {shard_count}")
+        print_usage()
+        sys.exit(1)
+
+    if workers < 1:
+        logging.error(f"Invalid worker count: {workers}")
+        print_usage()
+        sys.exit(1)
+
+    for channel, names in (('sms', sms_providers), ('email', email_providers)):
+        unknown = [name for name in names if name not in PROVIDERS[channel]]
+        if unknown or not names:
+            logging.error(f"Invalid {channel} providers: {','.join(names)}")
+            print_usage()
+            sys.exit(1)
+
+    reload_requested = bool(tuning_file) # Apply the file on the first batch too, not only after a SIGHUP
+
+    if job_id and job_id.isdigit(): # Launcher job ids are 01..N so they map onto distinct shards
+        shard_index = (int(job_id) - 1) % shard_count
+    else:
+        shard_index = zlib.crc32((job_id or "").encode()) % shard_count
+
     my_process_identifier = HOSTNAME
     if mode:
         my_process_identifier += f"-{mode}"
@@ -471,42 +1732,190 @@ def initialize_logs():
         print(f"Failed to initialize logging: {e}", file=sys.stderr)
         sys.exit(1)
 
+def load_db_params():
+    global db_params
+    with open(f"{user_home}/scripts/db_params.json") as f:
+        db_params = json.load(f)
+        db_params["password"] = pgpassword
+
+def get_sms_client():
+    global sms_client
+    with client_lock: # Send threads can race to create it
+        if sms_client is None:
+            from twilio.rest import Client # Deferred so report workers never load the Twilio SDK
+            sms_client = Client(twilio_api_key_sid,twilio_api_key_secret,twilio_account_sid)
+    return sms_client
+
+def get_sendgrid_client():
+    global sg
+    with client_lock: # Send threads can race to create it
+        if sg is None:
+            import sendgrid # Deferred so SMS-only workers never load SendGrid
+            sg = sendgrid.SendGridAPIClient(sendgrid_client_api_key)
+    return sg
+
 def initialize_clients():
-    global sg, sms_client, conn
+    global conn, executor
     try:
-        sg = sendgrid.SendGridAPIClient(sendgrid_client_api_key)
-        sms_client = Client(twilio_api_key_sid,twilio_api_key_secret,twilio_account_sid)
+        if workers > 1:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sender")
+        load_db_params()
+        initialize_sms_senders()
         conn = psycopg2.connect(**db_params, cursor_factory=DictCursor)
     except Exception as e:
         logging.exception(f"Client initialization error: {e}")
         sys.exit(1)
 
+def set_tunable(name, raw):
+    if name not in TUNABLES:
+        logging.warning(f"Ignoring unknown tuning value {name}")
+        return
+    var, cast = TUNABLES[name]
+    try:
+        value = cast(raw) if raw not in (None, "") else None
+    except ValueError:
+        logging.error(f"Invalid tuning value {name}={raw!r}")
+        return
+    if var == "phone_override" and value and value.lower() == 'twilio':
+        value = TWILIO_MAGIC_PHONE_NUMBER_FOR_TESTING
+    if var not in ("email_override", "phone_override") and (value is None or value <= 0):
+        logging.error(f"Invalid tuning value {name}={raw!r}")
+        return
+
+    if globals()[var] != value:
+        logging.info(f"Tuning {name}: {globals()[var]} -> {value}")
+        globals()[var] = value
+
+def load_tuning_file():
+    try:
+        with open(tuning_file) as f:
+            values = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not read tuning file {tuning_file}: {e}")
+        return
+    for name, raw in values.items():
+        set_tunable(name, raw)
+
+def load_tuning_table():
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        select_sql = """
+        SELECT name, value
+        FROM mail."MessengerConfig"
+        WHERE target IN ('*', %s, %s)
+        ORDER BY CASE target WHEN '*' THEN 0 WHEN %s THEN 1 ELSE 2 END -- Most specific target wins
+        """
+        params = (mode or 'all', my_process_identifier, mode or 'all')
+        cursor.execute(select_sql,params)
+        rows = cursor.fetchall()
+        conn.commit()
+        for row in rows:
+            set_tunable(row["name"], row["value"])
+    except psycopg2.Error as e:
+        logging.error(f"Could not read tuning table: {e}")
+        conn.rollback()
+    finally:
+        if cursor:
+            cursor.close()
+
+def apply_runtime_tuning():
+    global reload_requested, last_config_poll
+    poll_due = config_table and time.monotonic() - last_config_poll >= CONFIG_POLL_SECONDS
+    if not reload_requested and not poll_due:
+        return
+
+    if reload_requested and tuning_file:
+        load_tuning_file()
+    if config_table:
+        load_tuning_table()
+        last_config_poll = time.monotonic()
+    reload_requested = False
+
+def seconds_until_next_due():
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+        SELECT EXTRACT(EPOCH FROM MIN(send_at) - NOW()) AS wait
+        FROM mail."MailQueue"
+        WHERE "deliveryMethod" IS NULL AND send_at > NOW()
+        """)
+        wait = cursor.fetchone()["wait"]
+        conn.commit()
+        return float(wait) if wait is not None else float("inf")
+    except psycopg2.Error as e:
+        logging.error(f"Could not read next scheduled send: {e}")
+        conn.rollback()
+        return float("inf")
+    finally:
+        if cursor:
+            cursor.close()
+
+def next_due_delay():
+    global next_due_at, next_due_checked
+    now = time.monotonic()
+    if now - next_due_checked >= NEXT_DUE_REFRESH or next_due_at <= now: # Otherwise idle cycles would add a query each
+        next_due_at = now + seconds_until_next_due()
+        next_due_checked = now
+    return next_due_at - now
+
 def run_worker_loop():
+    if profile_batches:
+        start_profile(profile_batches)
+
     while not should_terminate:
         try:
+            apply_runtime_tuning() # Batch boundary
+            profile_batch_start()
             success, failed, skipped = process_records()
+            profile_batch_end()
             processed_record_count = success + failed + skipped
 
             if debug_mode and processed_record_count > 0:
                 logging.debug(f"Batch complete. Success: {success}, Failed: {failed}, Skipped: {skipped}")
 
+            log_metrics()
+
             if not loop:
+                flush_archive_buffer(force=True)
+                log_metrics(force=True)
                 if conn:
                     conn.close()
                 break
 
-            time.sleep(interval * random.uniform(0.8, 1.2)) # Don't hammer the DB
+            delay = interval * random.uniform(0.8, 1.2) # Don't hammer the DB
+            if processed_record_count == 0: # Wake up right when the next scheduled message is due
+                delay = max(0.0, min(delay, next_due_delay()))
+            time.sleep(delay)
         except Exception as e:
             logging.exception(f"Unexpected error: {e}")
             if conn:
                 conn.close()
             sys.exit(1) # Let cron restart the job
 
+    if profiler:
+        stop_profile()
+
+    if loop:
+        flush_archive_buffer(force=True) # Don't leave sent rows leased on shutdown
+        release_claimed_rows()
+
+    if executor is not None:
+        executor.shutdown(wait=not should_terminate, cancel_futures=True)
+
 def main():
     parse_args()
     initialize_logs()
+    if command:
+        initialize_clients()
+        command()
+        return
     if running_process_check():
         initialize_clients()
+        if not testing: # Test runs roll back, so their sends must not be journaled
+            open_journal()
+            reconcile_journal()
         run_worker_loop()
 
 if __name__ == '__main__':
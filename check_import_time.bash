@@ -0,0 +1,57 @@
+#!/usr/bin/env bash
+
+directory="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+BUDGET_MS=""
+
+# --- Parse named arguments ---
+while [[ $# -gt 0 ]]; do
+  case "$1" in
+    --budget-ms)
+      BUDGET_MS="$2"
+      shift 2
+      ;;
+    --budget-ms=*)
+      BUDGET_MS="${1#*=}"
+      shift
+      ;;
+    -*|--*)
+      echo "Unknown option: $1"
+      exit 1
+      ;;
+    *)
+      echo "Unexpected argument: $1"
+      exit 1
+      ;;
+  esac
+done
+
+BUDGET_MS="${BUDGET_MS:-250}" # Default budget for everything imported before the first claim
+
+# --- Validate budget ---
+if ! [[ "$BUDGET_MS" =~ ^[1-9][0-9]*$ ]]; then
+  echo "Error: --budget-ms must be a positive integer. Exiting"
+  exit 1
+fi
+
+status=0
+for filename in acs_messenger.py acs_messenger_async.py; do
+    # --help exits right after argument parsing, so this is the module level import cost of a worker
+    report=$(python3 -X importtime "$directory/$filename" --help 2>&1 >/dev/null)
+    total_us=$(echo "$report" | awk -F'|' '$2 ~ /^ *[0-9]+ *$/ && $3 ~ /^ [^ ]/ { sum += $2 } END { print sum + 0 }')
+    total_ms=$((total_us / 1000))
+
+    if echo "$report" | grep -qE '\| +(twilio|sendgrid|psutil)$'; then
+        echo "$filename: provider SDK or psutil imported at module load"
+        status=1
+    fi
+
+    if [[ $total_ms -gt $BUDGET_MS ]]; then
+        echo "$filename: import time ${total_ms}ms exceeds budget of ${BUDGET_MS}ms. Slowest imports:"
+        echo "$report" | awk -F'|' '$2 ~ /^ *[0-9]+ *$/ && $3 ~ /^ [^ ]/' | sort -t'|' -k2 -n -r | head -5
+        status=1
+    else
+        echo "$filename: import time ${total_ms}ms (budget ${BUDGET_MS}ms)"
+    fi
+done
+
+exit $status
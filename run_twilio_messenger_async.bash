@@ -47,7 +47,7 @@ function launch_jobs() {
         for i in $(seq $start_id $JOB_COUNT); do
           job_id=$(printf "%02d" "$i")
           echo "Launching $mode job $job_id"
-          nohup python3 "$script" --mode="$mode" --job-id="$job_id" --loop --debug &
+          nohup python3 "$script" --mode="$mode" --job-id="$job_id" --shards="$JOB_COUNT" --loop --debug &
         done
     fi
 }
@@ -0,0 +1,30 @@
+import random
+
+import pytest
+
+pytest.importorskip("psycopg2")
+import acs_messenger
+
+
+@pytest.fixture(autouse=True)
+def default_max_segments(monkeypatch):
+    monkeypatch.setattr(acs_messenger, "max_segments", acs_messenger.SMS_MAX_SEGMENTS)
+
+
+def test_truncated_surrogate_pairs_fit_max_segments():
+    msg, encoding, segments, truncated = acs_messenger.build_sms_body("S", "🔥" * 140)
+    assert encoding == "UCS-2"
+    assert truncated
+    assert segments == acs_messenger.SMS_MAX_SEGMENTS
+    assert msg.endswith("…")
+
+
+def test_truncation_never_exceeds_max_segments(monkeypatch):
+    rng = random.Random(1)
+    alphabet = "abc 🔥😀é漢字"
+    for _ in range(500):
+        limit = rng.randint(1, 5)
+        monkeypatch.setattr(acs_messenger, "max_segments", limit)
+        body = "".join(rng.choice(alphabet) for _ in range(rng.randint(50, 800)))
+        _, _, segments, _ = acs_messenger.build_sms_body("Alarm", body, rng.random() < 0.5)
+        assert segments <= limit